@@ -1,17 +1,19 @@
-import io
+import asyncio
+import hashlib
 import logging
 import os
 import re
 import sqlite3
+import tempfile
 import traceback
 from urllib.parse import urljoin
 
 import httpx
-import requests
-import tweepy
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
 from dotenv import load_dotenv
 from google import genai
+from google.genai import errors, types
+from tweepy.asynchronous import AsyncClient
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_FILE_PATH = os.path.join(BASE_DIR, 'council_scraper.log')
@@ -21,22 +23,24 @@ DB_PATH = os.path.join(BASE_DIR, 'council_meetings.db')
 logger = logging.getLogger('council_scraper')
 logger.setLevel(logging.INFO)
 
-# Create console handler and set level
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
+# Only add handlers the first time, so importing the module again does not duplicate every log line
+if not logger.handlers:
+    # Create console handler and set level
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
 
-# Create file handler and set level
-file_handler = logging.FileHandler(LOG_FILE_PATH, "a", "utf-8")
-file_handler.setLevel(logging.INFO)
+    # Create file handler and set level
+    file_handler = logging.FileHandler(LOG_FILE_PATH, "a", "utf-8")
+    file_handler.setLevel(logging.INFO)
 
-# Create formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
+    # Create formatter
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    console_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
 
-# Add handlers to logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+    # Add handlers to logger
+    logger.addHandler(console_handler)
+    logger.addHandler(file_handler)
 
 # Load API keys from environment variables
 load_dotenv()
@@ -49,22 +53,84 @@ X_API_BEARER_TOKEN = os.getenv("X_API_BEARER_TOKEN")
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# API clients are created once so their sessions and connection pools are reused for every meeting
+GEMINI = genai.Client(api_key=GEMINI_API_KEY)
+
+TWITTER = AsyncClient(
+    X_API_BEARER_TOKEN,
+    X_API_CONSUMER_KEY,
+    X_API_CONSUMER_KEY_SECRET,
+    X_API_ACCESS_TOKEN,
+    X_API_ACCESS_TOKEN_SECRET
+)
+
 # Council URL where table of PDFs is stored
 COUNCIL_URL = "https://huttcity.infocouncil.biz/"
 
+# Agenda PDFs, excluding supplementary agendas. Compiled once so the whole filter runs inside BeautifulSoup.
+AGENDA_PDF_PATTERN = re.compile(r"^(?!.*SUP).*AGN.*\.PDF$")
+
+# PDFs up to this size are kept in memory while downloading, larger ones are spilled to a temporary file on disk
+PDF_SPOOL_MAX_SIZE = 8 << 20
+
+# Largest PDF sent inline to Gemini, anything bigger goes through the Files API. Inline data is base64 encoded, which
+# makes it about 4/3 larger, and Gemini rejects requests over 20 MB. 14 MB encodes to roughly 18.7 MB, which leaves
+# room for the prompt.
+INLINE_PDF_MAX_SIZE = 14_000_000
+
+PDF_MIME_TYPE = 'application/pdf'
+PDF_UPLOAD_CONFIG = {"mime_type": PDF_MIME_TYPE}
+
+# Number of attempts made for each Gemini request before giving up on a transient server error
+GEMINI_MAX_ATTEMPTS = 5
+
+# Shared async HTTP client so PDF downloads and page fetches can run concurrently and reuse kept-alive connections
+HTTP = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    follow_redirects=True,
+    timeout=120
+)
+
+GEMINI_MODEL = "gemini-2.0-flash"
+
+# X allows 280 characters, this leaves a margin for things the length count below does not model, such as links
+# being shortened to 23 characters
+TWEET_LENGTH_LIMIT = 270
+
+# Code point ranges that X counts as a single character, everything else (including "•" and emoji) counts as two
+TWEET_SINGLE_WEIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+
+# Longest thread numbering suffix that post_to_twitter adds to a tweet
+TWEET_NUMBERING_RESERVE = " (99/99)"
+
+# Maximum number of agendas being summarized by Gemini at once
+GEMINI_CONCURRENCY = 8
+
+# Maximum number of Twitter threads being posted at once, to avoid hitting the rate limit
+TWITTER_CONCURRENCY = 5
+
 
 def get_db_connection():
     """Connect to SQLite database."""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    # WAL with synchronous=NORMAL avoids an fsync on every commit while remaining safe against corruption
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
     cursor.execute('''CREATE TABLE IF NOT EXISTS council_meetings (
     timestamp TEXT NOT NULL,
     committee_name TEXT NOT NULL,
     url TEXT PRIMARY KEY NOT NULL,
     x_url TEXT NOT NULL,
-    summary TEXT NOT NULL
+    summary TEXT NOT NULL,
+    content_sha256 TEXT
     )
     ''')
+    # Databases created before PDF hashes were stored need the column added
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(council_meetings)")}
+    if 'content_sha256' not in columns:
+        cursor.execute("ALTER TABLE council_meetings ADD COLUMN content_sha256 TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS council_meetings_content_sha256 ON council_meetings (content_sha256)")
     conn.commit()
     return conn, cursor
 
@@ -72,85 +138,163 @@ def get_db_connection():
 conn, cursor = get_db_connection()
 
 
-def scrape_links():
+async def scrape_links():
     """Scrape agenda PDFs from council website."""
 
     try:
 
         logger.info("Scraping links from council website...")
-        response = requests.get(COUNCIL_URL)
+        response = await HTTP.get(COUNCIL_URL)
 
-        soup = BeautifulSoup(response.text, "html.parser")
+        # Pass the raw bytes so lxml can detect the page encoding itself
+        soup = BeautifulSoup(response.content, "lxml")
 
+        # Looking for agenda pdfs
+        # This is because the PDFs of the meeting minutes are delayed by 4 months, and the agenda PDFs contain the
+        # decisions that the council has made regardless
         # Change limit to adjust how far the program should look back through the agenda files
-        found_links = soup.find_all("a", href=re.compile(r"\.PDF$"), limit=1)
-        new_links = []
+        found_links = soup.find_all("a", href=AGENDA_PDF_PATTERN, limit=1)
+        committee_names = map_committee_names(found_links)
+        pending_links = []
 
-        for link in found_links:
-            # Looking for agenda pdfs
-            # This is because the PDFs of the meeting minutes are delayed by 4 months, and the agenda PDFs contain the
-            # decisions that the council has made regardless
+        # Load every processed URL up front rather than querying the database once per link
+        seen_urls = {row[0] for row in cursor.execute("SELECT url FROM council_meetings")}
 
-            if link['href'].endswith('.PDF') and 'AGN' in link['href'] and 'SUP' not in link['href']:
-                found_link = urljoin(COUNCIL_URL, link['href'])
-                logger.info("Found link: %s", found_link)
+        for link in found_links:
+            # The agenda filtering has already been done by AGENDA_PDF_PATTERN, so only the href is needed here
+            href = link['href']
+            found_link = urljoin(COUNCIL_URL, href)
+            logger.info("Found link: %s", found_link)
 
-                cursor.execute("SELECT url FROM council_meetings WHERE url = ?", (found_link,))
-                existing_url = cursor.fetchone()
-                if existing_url:
-                    logger.info("File from %s has already been downloaded. Skipping.", link)
+            if found_link in seen_urls:
+                logger.info("File from %s has already been downloaded. Skipping.", found_link)
 
+            else:
+                committee_name = committee_names.get(href)
+                if committee_name:
+                    logger.info(f"Meeting Name found: {committee_name}")
                 else:
-                    logger.info("Downloading %s", found_link)
-                    committee_name = find_committee_name_from_link(link)
-                    logger.info("Added %s to list of found links.", found_link)
-                    new_links.append((committee_name, found_link))
-                    with open("downloaded.pdf", "wb") as f:
-                        f.write(httpx.get(found_link).content)
+                    committee_name = "Unknown Committee"
+                    logger.info("Meeting name not found")
+
+                logger.info("Added %s to list of found links.", found_link)
+                pending_links.append((committee_name, found_link))
+
+        # Download every new agenda concurrently, keeping the files so they are only fetched once
+        downloads = await asyncio.gather(*(download_pdf(found_link) for _, found_link in pending_links),
+                                         return_exceptions=True)
+        new_links = []
+        for (committee_name, found_link), download in zip(pending_links, downloads):
+            # A failed download only skips that agenda, it will be tried again on the next run
+            if isinstance(download, BaseException):
+                logger.error("Error downloading %s: %s", found_link, download)
+                continue
+
+            pdf_file, content_sha256 = download
+            new_links.append((committee_name, found_link, pdf_file, content_sha256))
 
         return new_links
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error("Error scraping council website: %s", e)
 
         return []
 
 
-def find_committee_name_from_link(link):
-    parent = link.parent
-    committee_td = parent.find_previous_sibling('td', class_='bpsGridCommittee')
+async def download_pdf(link):
+    """Stream an agenda PDF into a temporary file, returning it along with the SHA-256 hash of its contents."""
+    # The spooled file only spills to disk for large agendas
+    logger.info("Downloading %s", link)
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_SIZE)
+    content_hash = hashlib.sha256()
+    try:
+        async with HTTP.stream("GET", link) as response:
+            # Don't pass an HTML error page on to Gemini as if it were the agenda
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                pdf_file.write(chunk)
+                content_hash.update(chunk)
+    except BaseException:
+        pdf_file.close()
+        raise
+
+    pdf_file.seek(0)
+    return pdf_file, content_hash.hexdigest()
+
+
+def find_meeting_by_hash(content_sha256):
+    """Find the summary and X thread of an already processed agenda with identical contents."""
+    return conn.execute(
+        "SELECT summary, x_url FROM council_meetings WHERE content_sha256 = ?", (content_sha256,)
+    ).fetchone()
+
+
+def map_committee_names(links):
+    """Map the href of each found agenda PDF to its committee name, reading each table row only once."""
+    committee_names = {}
+    # Committee name of each row already read, keyed by id() as several links can share a row
+    row_names = {}
+    for link in links:
+        row = link.find_parent('tr')
+        if row is None:
+            continue
+
+        if id(row) not in row_names:
+            committee_td = row.find('td', class_='bpsGridCommittee')
+            row_names[id(row)] = find_committee_name_from_cell(committee_td) if committee_td else None
+
+        if row_names[id(row)]:
+            committee_names[link['href']] = row_names[id(row)]
+
+    return committee_names
+
+
+def find_committee_name_from_cell(committee_td):
     br_tag = committee_td.find('br')
-    if committee_td and br_tag:
-        # Extract the text from the previous sibling
-        committee_name = br_tag.previous_sibling.strip()
-        logger.info(f"Meeting Name found: {committee_name}")
-    elif committee_td:
-        committee_name = committee_td.text.strip()
-        logger.info(f"Meeting Name found: {committee_name}")
-    else:
-        committee_name = "Unknown Committee"
-        logger.info("Meeting name not found")
+    # The committee name is the text before the <br>, but only when that is plain text rather than another tag
+    if br_tag and isinstance(br_tag.previous_sibling, NavigableString):
+        return br_tag.previous_sibling.strip()
+
+    return committee_td.text.strip()
+
 
-    return committee_name
+async def retry_gemini_request(request):
+    """Await a Gemini request, retrying with exponential backoff when Gemini returns a server error."""
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            return await request()
+        except errors.ServerError as e:
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
 
+            delay = 2 ** attempt
+            logger.warning("Gemini server error, retrying in %d seconds: %s", delay, e)
+            await asyncio.sleep(delay)
 
-def summarize_with_gemini(committee_name, link):
+
+async def summarize_with_gemini(committee_name, link, pdf_file):
     """Generate a summary using Google's Gemini API."""
     try:
         logger.info("Summarizing with gemini...")
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        doc_io = io.BytesIO(httpx.get(link, follow_redirects=True, timeout=120).content)
-        logger.debug(doc_io.getvalue())
+        pdf_size = pdf_file.seek(0, os.SEEK_END)
+        pdf_file.seek(0)
+        # Only log the size, the PDF contents are binary and can be many megabytes
+        logger.debug("PDF size: %d bytes", pdf_size)
 
-        if doc_io.getbuffer().nbytes < 100:  # Arbitrary small size check
-            logger.warning(f"Warning: File size is very small {doc_io.getbuffer().nbytes} bytes). May not be a valid "
+        if pdf_size < 100:  # Arbitrary small size check
+            logger.warning(f"Warning: File size is very small {pdf_size} bytes). May not be a valid "
                            f"PDF.")
 
-        sample_doc = client.files.upload(
-            file=doc_io,
-            config=dict(
-                mime_type='application/pdf')
-        )
+        if pdf_size <= INLINE_PDF_MAX_SIZE:
+            # Small PDFs are sent inline with the request, saving the upload round trip
+            sample_doc = types.Part.from_bytes(data=pdf_file.read(), mime_type=PDF_MIME_TYPE)
+        else:
+            async def upload_pdf():
+                # A failed attempt may have read part of the file, so always upload from the start
+                pdf_file.seek(0)
+                return await GEMINI.aio.files.upload(file=pdf_file, config=PDF_UPLOAD_CONFIG)
+
+            sample_doc = await retry_gemini_request(upload_pdf)
 
         prompt = f"""
         Summarize this city council meeting into short paragraphs.
@@ -175,7 +319,10 @@ def summarize_with_gemini(committee_name, link):
 
         """
 
-        response = client.models.generate_content(model="gemini-2.0-flash", contents=[sample_doc, prompt])
+        # The uploaded file is reused if generating the summary has to be retried
+        response = await retry_gemini_request(
+            lambda: GEMINI.aio.models.generate_content(model=GEMINI_MODEL, contents=[sample_doc, prompt])
+        )
         if response:
             logger.info("Successfully generated summary")
 
@@ -183,27 +330,15 @@ def summarize_with_gemini(committee_name, link):
         else:
             logger.error("Error generating summary.")
 
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP Error downloading PDF from {link}: {e.response.status_code} - {e.response.text}")
-    except httpx.RequestError as e:
-        logger.error(f"Request Error downloading PDF from {link}: {traceback.format_exc()}")
     except Exception as e:
         # Catch the specific Gemini API error if possible, otherwise generic
         logger.error(f"Error summarizing with Gemini: {e}")
 
 
-def post_to_twitter(summary):
+async def post_to_twitter(summary):
     """Post summary to Twitter as a thread."""
 
     try:
-        client = tweepy.Client(
-            X_API_BEARER_TOKEN,
-            X_API_CONSUMER_KEY,
-            X_API_CONSUMER_KEY_SECRET,
-            X_API_ACCESS_TOKEN,
-            X_API_ACCESS_TOKEN_SECRET
-        )
-
         prev_tweet_id = None
         first_tweet_id = None  # storing the first tweet ID.
         tweet_chunks = generate_tweet(summary.splitlines())
@@ -213,7 +348,8 @@ def post_to_twitter(summary):
 
         for x, tweet in enumerate(tweet_chunks):
             tweet = tweet + f" ({x + 1}/{tweet_chunks_len})"
-            response = client.create_tweet(text=tweet, in_reply_to_tweet_id=prev_tweet_id)
+            # Tweets within a thread are posted in order, as each one replies to the previous tweet
+            response = await TWITTER.create_tweet(text=tweet, in_reply_to_tweet_id=prev_tweet_id)
             logger.info(f"Posted tweet to Twitter: {tweet}")
             prev_tweet_id = response.data['id']
             if first_tweet_id is None:
@@ -221,9 +357,7 @@ def post_to_twitter(summary):
         logger.info("Tweets posted successfully.")
 
         if first_tweet_id:
-            user = client.get_me()
-            username = user.data.username
-            first_tweet_url = f"https://x.com/{username}/status/{first_tweet_id}"
+            first_tweet_url = f"https://x.com/{await get_x_username()}/status/{first_tweet_id}"
             return first_tweet_url
         else:
             return None
@@ -233,69 +367,134 @@ def post_to_twitter(summary):
                      traceback.format_exc())
 
 
+# Cached X username, see get_x_username
+x_username = None
+
+
+async def get_x_username():
+    """Look up the bot's X username. It cannot change while the program runs, so it is only fetched once."""
+    global x_username
+    if x_username is None:
+        x_username = (await TWITTER.get_me()).data.username
+    return x_username
+
+
+def tweet_length(text):
+    """Length of text as counted by X, where most characters outside of Latin scripts count twice."""
+    return sum(
+        1 if any(start <= ord(char) <= end for start, end in TWEET_SINGLE_WEIGHT_RANGES) else 2
+        for char in text
+    )
+
+
 def generate_tweet(lines):
-    tweet_length_limit = 270
+    """Split the summary into tweet sized chunks, breaking only between words."""
+    # Leave room in every tweet for the thread numbering that post_to_twitter appends
+    tweet_length_limit = TWEET_LENGTH_LIMIT - tweet_length(TWEET_NUMBERING_RESERVE)
     tweets = []
-    tweet = ""
+    words = []
+    length = 0
 
     for line in lines:
-        len_line = len(line)
+        for word in line.split():
+            # Every word after the first in a tweet is preceded by a space
+            word_length = tweet_length(word)
+            added_length = word_length + 1 if words else word_length
+
+            if words and length + added_length > tweet_length_limit:
+                tweets.append(" ".join(words))
+                words = [word]
+                length = word_length
+            else:
+                words.append(word)
+                length += added_length
 
-        if len_line >= tweet_length_limit:
-            tweets.append(tweet)
-            tweet = ""
+    if words:
+        tweets.append(" ".join(words))
+    return tweets
 
-            new_line_1 = ""
-            new_line_2 = ""
 
-            length = 0
-            for word in line.split():
-                length += (len(word) + 1)
+async def process_link(committee_name, link, pdf_file, content_sha256, gemini_semaphore, twitter_semaphore):
+    """Summarize a single agenda and post it as a thread."""
+    with pdf_file:
+        async with gemini_semaphore:
+            summary = await summarize_with_gemini(committee_name, link, pdf_file)
 
-                if length < tweet_length_limit:
-                    new_line_1 += word + " "
-                if length >= tweet_length_limit:
-                    new_line_2 += word + " "
+    # summarize_with_gemini has already logged why it failed. Nothing is posted, so the meeting is retried next run.
+    if not summary:
+        return committee_name, link, None, summary, content_sha256
 
-            tweets.append(new_line_1)
-            tweets.append(new_line_2)
-        else:
-            len_tweet = len(tweet)
-
-            if len_tweet >= tweet_length_limit:
-                tweets.append(tweet)
-                tweet = line
-            elif len_tweet + len_line >= tweet_length_limit:
-                tweets.append(tweet)
-                tweet = line
+    # Threads for different meetings are posted concurrently, up to the semaphore's limit
+    async with twitter_semaphore:
+        x_link = await post_to_twitter(summary)
+
+    return committee_name, link, x_link, summary, content_sha256
+
+
+async def run_pipeline():
+    """Scrape, summarize and post all new agendas concurrently."""
+    try:
+        found_links = await scrape_links()
+
+        # Agendas are sometimes republished under a new URL, possibly more than once in the same run. Only the first
+        # copy of each document is summarized and posted, the others reuse its summary and thread.
+        unique_links = {}
+        copies = []
+        for committee_name, link, pdf_file, content_sha256 in found_links:
+            if content_sha256 in unique_links or find_meeting_by_hash(content_sha256):
+                pdf_file.close()
+                copies.append((committee_name, link, content_sha256))
             else:
-                tweet += line + " "
+                unique_links[content_sha256] = (committee_name, link, pdf_file, content_sha256)
+
+        if unique_links:
+            # Resolve the username up front so threads posted concurrently don't each look it up
+            try:
+                await get_x_username()
+            except Exception as e:
+                logger.warning("Could not look up X username, will retry after posting: %s", e)
+
+        gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+        twitter_semaphore = asyncio.Semaphore(TWITTER_CONCURRENCY)
+        results = await asyncio.gather(
+            *(process_link(committee_name, link, pdf_file, content_sha256, gemini_semaphore, twitter_semaphore)
+              for committee_name, link, pdf_file, content_sha256 in unique_links.values())
+        )
+    finally:
+        await HTTP.aclose()
 
-    if tweet != "":
-        tweets.append(tweet)
-    return tweets
+    processed_meetings = {content_sha256: (summary, x_link) for _, _, x_link, summary, content_sha256 in results}
+    for committee_name, link, content_sha256 in copies:
+        summary, x_link = (processed_meetings.get(content_sha256) or find_meeting_by_hash(content_sha256)
+                           or (None, None))
+        logger.info("%s has the same contents as another agenda. Reusing its summary.", link)
+        results.append((committee_name, link, x_link, summary, content_sha256))
+
+    # Only keep meetings where every step succeeded so failed ones are retried on the next run
+    return [row for row in results if all(row)]
 
 
 def main():
     """Main function to execute the workflow."""
     try:
-        found_links = scrape_links()
-        data_to_insert = []
-        for committee_name, link in found_links:
-            summary = summarize_with_gemini(committee_name, link)
-            x_link = post_to_twitter(summary)
-            if committee_name and link and x_link and summary:
-                data_to_insert.append((committee_name, link, x_link, summary))
+        data_to_insert = asyncio.run(run_pipeline())
 
         if data_to_insert:
-            cursor.executemany("INSERT INTO council_meetings VALUES (DATETIME('now'),?, ?, ?, ?)", data_to_insert)
-            logger.info("Successfully inserted data")
-            conn.commit()
-        conn.close()
+            # Insert every row in a single transaction, which is committed on success and rolled back on error.
+            # Rows are validated in run_pipeline, and OR IGNORE skips any URL that is already stored rather than
+            # aborting the whole batch.
+            with conn:
+                inserted = conn.executemany(
+                    "INSERT OR IGNORE INTO council_meetings "
+                    "(timestamp, committee_name, url, x_url, summary, content_sha256) "
+                    "VALUES (DATETIME('now'), ?, ?, ?, ?, ?)",
+                    data_to_insert
+                ).rowcount
+            logger.info("Successfully inserted data for %d of %d meetings", inserted, len(data_to_insert))
     except KeyboardInterrupt:
         logger.info("Program has been closed by the user")
-    except sqlite3.IntegrityError as e:
-        logger.error("Sqllite Not Null clause violated: %s", e)
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":